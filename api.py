@@ -1,6 +1,126 @@
+import asyncio
+import functools
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass
 import orjson
 import httpx
-from typing import Optional
+from email.parser import BytesParser
+from typing import List, Optional, Union
+from urllib.parse import urlencode
+
+# Endpoint name -> path below /xapi/v1/
+_ENDPOINTS = {
+    "custom_prompts": "CustomPrompts",
+    "playlists": "Playlists",
+    "receptionists": "Receptionists",
+    "queues": "Queues",
+    "groups": "Groups",
+    "conference_settings": "ConferenceSettings",
+    "emergency_notifications_settings": "EmergencyNotificationsSettings",
+    "call_parking_settings": "CallParkingSettings",
+    "call_flow_apps": "CallFlowApps",
+    "music_on_hold_settings": "MusicOnHoldSettings",
+    "batch": "$batch",
+}
+
+# Query parameters are identical on every call, so build them once
+_MOH_SELECT = ",".join(f"MusicOnHold{i}" for i in range(10))
+_CUSTOM_PROMPTS_PARAMS = {"$select": "DisplayName"}
+_PLAYLISTS_PARAMS = {"$select": "Name,Files"}
+_RECEPTIONISTS_PARAMS = {"$select": "Name,Number,PromptFilename", "$expand": "Forwards($select=Input,CustomData)"}
+_QUEUES_PARAMS = {
+    "$select": "Name,Number,IntroFile,OnHoldFile,GreetingFile,HolidaysRoute/Prompt,OutOfOfficeRoute/Prompt,BreakRoute/Prompt",
+}
+_GROUPS_PARAMS = {"$select": "Name,Number,OfficeRoute/Prompt,OutOfOfficeRoute/Prompt,BreakRoute/Prompt,HolidaysRoute/Prompt", "$filter": "not startsWith(Name, '___FAVORITES___')"}
+_CONFERENCE_SETTINGS_PARAMS = {"$select": "Extension,MusicOnHold"}
+_EMERGENCY_NOTIFICATIONS_SETTINGS_PARAMS = {"$select": "EmergencyPlayPrompt"}
+_CALL_PARKING_SETTINGS_PARAMS = {"$select": "MusicOnHold"}
+_CALL_FLOW_APPS_PARAMS = {"$select": "Id,Name,Number"}
+_CALL_FLOW_APPS_EXPAND_PARAMS = {"$select": "Id,Name,Number", "$expand": "Files"}
+_MUSIC_ON_HOLD_SETTINGS_PARAMS = {"$select": _MOH_SELECT}
+
+
+@dataclass
+class Payload:
+    """A JSON response body kept as the raw bytes the server sent.
+
+    `raw` can be persisted as-is; `data` is only decoded the first time it is accessed.
+    """
+
+    raw: bytes
+
+    @functools.cached_property
+    def data(self):
+        return orjson.loads(self.raw)
+
+    @classmethod
+    def from_data(cls, data) -> "Payload":
+        """Wrap a document that was assembled locally, serializing it exactly once."""
+        payload = cls(orjson.dumps(data))
+        payload.__dict__["data"] = data
+        return payload
+
+
+def _parse_batch_response(content_type: str, body: bytes) -> List[dict]:
+    """Split an OData multipart/mixed $batch response into the JSON body of each sub-response."""
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise ValueError("Expected a multipart $batch response")
+
+    results = []
+    for part in message.get_payload():
+        payload = part.get_payload(decode=True) or b""
+        head, _, part_body = payload.replace(b"\r\n", b"\n").partition(b"\n\n")
+        status_line = head.split(b"\n", 1)[0]
+        if status_line.split()[1:2] != [b"200"]:
+            raise ValueError(f"Unexpected $batch sub-response: {status_line!r}")
+        results.append(orjson.loads(part_body))
+    return results
+
+
+def _read_cache_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_cache_files(body_path: str, body: bytes, meta_path: str, etag: bytes) -> None:
+    # Write the body first so a stored ETag always has a body next to it
+    with open(body_path, "wb") as f:
+        f.write(body)
+    with open(meta_path, "wb") as f:
+        f.write(etag)
+
+
+def _memoized(method):
+    """Cache the result of an argument-less endpoint coroutine for the lifetime of the client.
+
+    The pending task is stored rather than the coroutine, so concurrent callers share one request
+    and later callers get the result without touching the network. Failed or cancelled requests
+    are not cached.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self):
+        task = self._memo.get(name)
+        if task is None:
+            task = asyncio.ensure_future(method(self))
+            self._memo[name] = task
+
+            def evict(done: asyncio.Future) -> None:
+                if (done.cancelled() or done.exception() is not None) and self._memo.get(name) is done:
+                    del self._memo[name]
+
+            task.add_done_callback(evict)
+        # Shield the shared task so one cancelled caller does not cancel it for everyone else
+        return await asyncio.shield(task)
+
+    return wrapper
 
 
 class APIClient:
@@ -9,85 +129,186 @@ class APIClient:
     Notes:
     - `token` should be a JWT/Bearer token.
     - `fqdn` should be the hostname (without scheme) or full host:port; scheme is added.
+    - `cache_dir`, when set, enables an ETag cache so unchanged GET payloads are not re-downloaded.
     """
 
-    def __init__(self, token: str, fqdn: str):
+    def __init__(self, token: str, fqdn: str, cache_dir: Optional[str] = None):
         self.token = token
         if token.startswith("Bearer "):
             self.token = token[len("Bearer ") :]
         # Use correct standard header names and values
-        headers = {"Accept": "application/json", "Authorization": f"Bearer {self.token}"}
-        self.client = httpx.Client(headers=headers, timeout=30.0)
+        headers = {
+            "Accept": "application/json",
+            # JSON compresses very well; httpx decodes brotli transparently when the brotli package is installed
+            "Accept-Encoding": "br, gzip",
+            "Authorization": f"Bearer {self.token}",
+        }
+        # Every request goes to the same host, so keep one multiplexed HTTP/2 connection alive.
+        # The pool settings live on the transport because httpx ignores them once a transport is given.
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60.0),
+            retries=2,
+        )
+        self.client = httpx.AsyncClient(headers=headers, timeout=30.0, transport=transport)
         self.fqdn = f"https://{fqdn}"
         if self.fqdn.endswith("/"):
             self.fqdn = self.fqdn[:-1]
+        self.xapi_url = self.fqdn + "/xapi/v1/"
+        # Parse each endpoint URL once; httpx uses URL instances as-is instead of re-parsing strings
+        self._urls = {name: httpx.URL(self.xapi_url + path) for name, path in _ENDPOINTS.items()}
+        self.cache_dir = cache_dir
+        self._memo: dict = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def invalidate(self) -> None:
+        """Forget the endpoint results memoized during this run."""
+        self._memo.clear()
+
+    async def __aenter__(self) -> "APIClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def request(self, method: str, url: Union[str, httpx.URL], **kwargs) -> httpx.Response:
+        if method != "GET" or not self.cache_dir:
+            response = await self.client.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+
+        key = hashlib.blake2b((str(url) + urlencode(kwargs.get("params") or {})).encode()).hexdigest()
+        meta_path = os.path.join(self.cache_dir, f"{key}.meta")
+        body_path = os.path.join(self.cache_dir, f"{key}.body")
+
+        # Cache files are touched off the event loop so they don't stall the other requests in flight
+        etag = (await asyncio.to_thread(_read_cache_file, meta_path) or b"").decode().strip()
+        if etag:
+            headers = {**(kwargs.get("headers") or {}), "If-None-Match": etag}
+            response = await self.client.request(method, url, **{**kwargs, "headers": headers})
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                body = await asyncio.to_thread(_read_cache_file, body_path)
+                if body is not None:
+                    # Serve the cached body as if the server had sent it again
+                    return httpx.Response(200, content=body, request=response.request)
+                # The body vanished since the ETag was read, so fetch the full payload again
+                response = await self.client.request(method, url, **kwargs)
+        else:
+            response = await self.client.request(method, url, **kwargs)
 
-    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
-        response = self.client.request(method, url, **kwargs)
         response.raise_for_status()
+        new_etag = response.headers.get("ETag")
+        if new_etag:
+            await asyncio.to_thread(_write_cache_files, body_path, response.content, meta_path, new_etag.encode())
         return response
 
-    def custom_prompts(self) -> Optional[dict]:
-        params = {"$select": "DisplayName"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/CustomPrompts", params=params)
-        return orjson.loads(response.content)
+    async def request_bytes(self, method: str, url: Union[str, httpx.URL], **kwargs) -> bytes:
+        """Return the raw response body so callers can persist it without a parse/serialize round-trip."""
+        response = await self.request(method, url, **kwargs)
+        return response.content
 
-    def playlists(self) -> Optional[dict]:
-        params = {"$select": "Name,Files"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/Playlists", params=params)
-        return orjson.loads(response.content)
+    @_memoized
+    async def custom_prompts(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["custom_prompts"], params=_CUSTOM_PROMPTS_PARAMS))
 
-    def receptionists(self) -> Optional[dict]:
-        params = {"$select": "Name,Number,PromptFilename", "$expand": "Forwards($select=Input,CustomData)"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/Receptionists", params=params)
-        return orjson.loads(response.content)
+    @_memoized
+    async def playlists(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["playlists"], params=_PLAYLISTS_PARAMS))
 
-    def queues(self) -> Optional[dict]:
-        params = {
-            "$select": "Name,Number,IntroFile,OnHoldFile,GreetingFile,HolidaysRoute/Prompt,OutOfOfficeRoute/Prompt,BreakRoute/Prompt",
-        }
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/Queues", params=params)
-        return orjson.loads(response.content)
-
-    def groups(self) -> Optional[dict]:
-        params = {"$select": "Name,Number,OfficeRoute/Prompt,OutOfOfficeRoute/Prompt,BreakRoute/Prompt,HolidaysRoute/Prompt", "$filter": "not startsWith(Name, '___FAVORITES___')"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/Groups", params=params)
-        return orjson.loads(response.content)
-
-    def conference_settings(self) -> Optional[dict]:
-        params = {"$select": "Extension,MusicOnHold"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/ConferenceSettings", params=params)
-        return orjson.loads(response.content)
-
-    def emergency_notifications_settings(self) -> Optional[dict]:
-        params = {"$select": "EmergencyPlayPrompt"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/EmergencyNotificationsSettings", params=params)
-        return orjson.loads(response.content)
-
-    def call_parking_settings(self) -> Optional[dict]:
-        params = {"$select": "MusicOnHold"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/CallParkingSettings", params=params)
-        return orjson.loads(response.content)
-
-    def call_flow_apps(self) -> Optional[dict]:
-        params = {"$select": "Id,Name,Number"}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/CallFlowApps", params=params)
-
-        content = orjson.loads(response.content)
-
-        # For each call flow app, fetch the files via the GetFiles action
-        for item in content.get("value", []):
-            item_id = item.get("Id")
-            if item_id is None:
-                item["Files"] = []
-                continue
-            files_response = self.request("GET", f"{self.fqdn}/xapi/v1/CallFlowApps({item_id})/Pbx.GetFiles()")
-            files_content = orjson.loads(files_response.content)
-            item["Files"] = files_content.get("value", [])
-
-        return content
-
-    def music_on_hold_settings(self) -> Optional[dict]:
-        params = {"$select": ",".join([f"MusicOnHold{i}" for i in range(10)])}
-        response = self.request("GET", f"{self.fqdn}/xapi/v1/MusicOnHoldSettings", params=params)
-        return orjson.loads(response.content)
+    @_memoized
+    async def receptionists(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["receptionists"], params=_RECEPTIONISTS_PARAMS))
+
+    @_memoized
+    async def queues(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["queues"], params=_QUEUES_PARAMS))
+
+    @_memoized
+    async def groups(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["groups"], params=_GROUPS_PARAMS))
+
+    @_memoized
+    async def conference_settings(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["conference_settings"], params=_CONFERENCE_SETTINGS_PARAMS))
+
+    @_memoized
+    async def emergency_notifications_settings(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["emergency_notifications_settings"], params=_EMERGENCY_NOTIFICATIONS_SETTINGS_PARAMS))
+
+    @_memoized
+    async def call_parking_settings(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["call_parking_settings"], params=_CALL_PARKING_SETTINGS_PARAMS))
+
+    async def call_flow_apps_meta(self) -> Optional[dict]:
+        return orjson.loads(await self.request_bytes("GET", self._urls["call_flow_apps"], params=_CALL_FLOW_APPS_PARAMS))
+
+    async def call_flow_files(self, item_id: int) -> list:
+        content = orjson.loads(await self.request_bytes("GET", f"{self.xapi_url}CallFlowApps({item_id})/Pbx.GetFiles()"))
+        return content.get("value", [])
+
+    async def call_flow_files_batch(self, item_ids: List[int]) -> List[list]:
+        """Fetch the GetFiles result of several call flow apps in a single OData $batch request."""
+        if not item_ids:
+            return []
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = [
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-Transfer-Encoding: binary\r\n\r\n"
+            f"GET CallFlowApps({item_id})/Pbx.GetFiles() HTTP/1.1\r\n"
+            "Accept: application/json\r\n\r\n"
+            for item_id in item_ids
+        ]
+        body = "".join(parts) + f"--{boundary}--\r\n"
+        response = await self.request(
+            "POST",
+            self._urls["batch"],
+            content=body.encode(),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+        )
+        results = _parse_batch_response(response.headers.get("Content-Type", ""), response.content)
+        if len(results) != len(item_ids):
+            raise ValueError("$batch response does not match the number of requests")
+        return [result.get("value", []) for result in results]
+
+    @_memoized
+    async def call_flow_apps(self) -> Payload:
+        # Preferably let the server inline the files so the whole list takes one round-trip
+        content = None
+        try:
+            payload = Payload(
+                await self.request_bytes("GET", self._urls["call_flow_apps"], params=_CALL_FLOW_APPS_EXPAND_PARAMS)
+            )
+            # Files comes from the GetFiles action, so a server may silently ignore the $expand;
+            # the app list it returned is still usable for fetching the files separately
+            if all("Files" in item for item in payload.data.get("value", [])):
+                return payload
+            content = payload.data
+        except httpx.HTTPStatusError:
+            pass
+
+        if content is None:
+            content = await self.call_flow_apps_meta()
+        items = content.get("value", [])
+        with_id = [item for item in items if item.get("Id") is not None]
+
+        # Otherwise bundle the GetFiles calls into one $batch, falling back to one request per app
+        try:
+            files = await self.call_flow_files_batch([item["Id"] for item in with_id])
+        except (httpx.HTTPError, ValueError):
+            files = await asyncio.gather(*[self.call_flow_files(item["Id"]) for item in with_id])
+
+        for item in items:
+            item["Files"] = []
+        for item, item_files in zip(with_id, files):
+            item["Files"] = item_files
+
+        return Payload.from_data(content)
+
+    @_memoized
+    async def music_on_hold_settings(self) -> Payload:
+        return Payload(await self.request_bytes("GET", self._urls["music_on_hold_settings"], params=_MUSIC_ON_HOLD_SETTINGS_PARAMS))
@@ -1,6 +1,13 @@
+import asyncio
+import itertools
+import mmap
 import os
 import shutil
-from typing import Dict, List, Optional
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 import orjson
 import api
 import argparse
@@ -9,11 +16,63 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+# Files in the output directory younger than this many seconds are reused instead of refetched (env: CACHE_TTL)
+DEFAULT_CACHE_TTL = 300
+
+# Below this size the cost of setting up a memory map outweighs the copy it saves
+MMAP_THRESHOLD = 64 * 1024
+
+
 def load_json_file(path: str) -> Optional[dict]:
-    if not os.path.exists(path):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
         return None
-    with open(path, "rb") as f:
-        return orjson.loads(f.read())
+    with f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return orjson.loads(f.read())
+        # Parse large exports straight from the page cache instead of copying them into a bytes object
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+
+# (field, description template) pairs, built once rather than per item
+_QUEUE_FILE_KEYS = tuple((key, f"Queue {key}: %s %s") for key in ("IntroFile", "OnHoldFile", "GreetingFile"))
+_QUEUE_ROUTE_KEYS = tuple((key, f"Queue route {key}: %s %s") for key in ("OutOfOfficeRoute", "BreakRoute", "HolidaysRoute"))
+_GROUP_ROUTE_KEYS = tuple(
+    (key, f"Group route {key}: %s %s") for key in ("OfficeRoute", "OutOfOfficeRoute", "BreakRoute", "HolidaysRoute")
+)
+
+
+# Candidates carry the template and its arguments so a description is only formatted for an actual match
+Candidate = Tuple[str, str, tuple]
+
+
+def _receptionist_candidates(items: list) -> Iterator[Candidate]:
+    for item in items:
+        get = item.get
+        label = (get("Number"), get("Name"))
+        yield get("PromptFilename"), "Receptionist: %s %s", label
+        for forward in get("Forwards", []):
+            yield forward.get("CustomData"), "Receptionist (forward key): %s %s", label
+
+
+def _queue_candidates(items: list) -> Iterator[Candidate]:
+    for item in items:
+        get = item.get
+        label = (get("Number"), get("Name"))
+        for key, template in _QUEUE_FILE_KEYS:
+            yield get(key), template, label
+        for key, template in _QUEUE_ROUTE_KEYS:
+            yield (get(key) or {}).get("Prompt"), template, label
+
+
+def _group_candidates(items: list) -> Iterator[Candidate]:
+    for item in items:
+        get = item.get
+        label = (get("Number"), get("Name"))
+        for key, template in _GROUP_ROUTE_KEYS:
+            yield (get(key) or {}).get("Prompt"), template, label
 
 
 def gather_prompt_usages(
@@ -26,67 +85,23 @@ def gather_prompt_usages(
     call_parking_settings: dict,
 ) -> Dict[str, List[str]]:
     """Return a mapping filename -> list of human-readable usage descriptions."""
-    usages: Dict[str, List[str]] = {fn: [] for fn in prompt_filenames}
-
-    # Helpers to add usage
-    def add(fn: str, text: str) -> None:
-        if fn in usages:
-            usages[fn].append(text)
-
-    # Receptionists
-    for item in (receptionists or {}).get("value", []):
-        filename = item.get("PromptFilename")
-        if filename and filename in prompt_filenames:
-            add(filename, f"Receptionist: {item.get('Number')} {item.get('Name')}")
-
-        for forward in item.get("Forwards", []):
-            custom_data = forward.get("CustomData")
-            if custom_data and custom_data in prompt_filenames:
-                add(custom_data, f"Receptionist (forward key): {item.get('Number')} {item.get('Name')}")
-
-    # Queues: direct file fields and route prompts
-    queue_file_keys = ["IntroFile", "OnHoldFile", "GreetingFile"]
-    route_keys = ["OutOfOfficeRoute", "BreakRoute", "HolidaysRoute"]
-
-    for item in (queues or {}).get("value", []):
-        for key in queue_file_keys:
-            value = item.get(key)
-            if value and value in prompt_filenames:
-                add(value, f"Queue {key}: {item.get('Number')} {item.get('Name')}")
-
-        for rkey in route_keys:
-            route = item.get(rkey, {}) or {}
-            prompt = route.get("Prompt")
-            if prompt and prompt in prompt_filenames:
-                add(prompt, f"Queue route {rkey}: {item.get('Number')} {item.get('Name')}")
-
-    # Groups routes
-    group_route_keys = ["OfficeRoute", "OutOfOfficeRoute", "BreakRoute", "HolidaysRoute"]
-    for item in (groups or {}).get("value", []):
-        for rkey in group_route_keys:
-            route = item.get(rkey, {}) or {}
-            prompt = route.get("Prompt")
-            if prompt and prompt in prompt_filenames:
-                add(prompt, f"Group route {rkey}: {item.get('Number')} {item.get('Name')}")
-
-    # Music on hold settings (look for keys starting with MusicOnHold)
-    for key, value in (music_on_hold_settings or {}).items():
-        if value and value in prompt_filenames:
-            add(value, f"MusicOnHold setting ({key})")
-
-    # Conference settings
-    conf_moh = (conference_settings or {}).get("MusicOnHold")
-    if conf_moh and conf_moh in prompt_filenames:
-        add(conf_moh, "Conference: MusicOnHold")
-
-    # Call parking
-    cps_moh = (call_parking_settings or {}).get("MusicOnHold")
-    if cps_moh and cps_moh in prompt_filenames:
-        add(cps_moh, "CallParking: MusicOnHold")
-
-    # Remove filenames with no usages
-    usages = {k: v for k, v in usages.items() if v}
-    return usages
+    # Every (filename, template, args) candidate that may reference a prompt, in report order
+    candidates = itertools.chain(
+        _receptionist_candidates((receptionists or {}).get("value", [])),
+        _queue_candidates((queues or {}).get("value", [])),
+        _group_candidates((groups or {}).get("value", [])),
+        ((value, "MusicOnHold setting (%s)", (key,)) for key, value in (music_on_hold_settings or {}).items()),
+        (((conference_settings or {}).get("MusicOnHold"), "Conference: MusicOnHold", ()),),
+        (((call_parking_settings or {}).get("MusicOnHold"), "CallParking: MusicOnHold", ()),),
+    )
+
+    # Only prompts get a list, so non-prompt references (e.g. the @odata.context URL) allocate nothing
+    usages: Dict[str, List[str]] = defaultdict(list)
+    is_prompt = prompt_filenames.__contains__
+    for filename, template, args in candidates:
+        if is_prompt(filename):
+            usages[filename].append(template % args)
+    return dict(usages)
 
 
 def print_report(usages: Dict[str, List[str]]) -> None:
@@ -94,19 +109,16 @@ def print_report(usages: Dict[str, List[str]]) -> None:
         print("No prompt files in use were found.")
         return
 
-    print("Detailed list of used prompt filenames:")
-    for filename in sorted(usages.keys()):
-        print(f"\n{filename}:")
-        for entry in usages[filename]:
-            print(f"  - {entry}")
-
-    print("\nUsed prompt filenames:")
-    for filename in sorted(usages.keys()):
-        print(f" - {filename}")
+    # Sort once and build the whole report up front so it goes out in a single write
+    filenames = sorted(usages)
+    detailed = "\n\n".join(f"{filename}:\n" + "\n".join(f"  - {entry}" for entry in usages[filename]) for filename in filenames)
+    summary = "\n".join(f" - {filename}" for filename in filenames)
+    sys.stdout.write(
+        "Detailed list of used prompt filenames:\n\n" + detailed + "\n\nUsed prompt filenames:\n" + summary + "\n"
+    )
 
 
-def print_call_flow_apps(client: api.APIClient) -> None:
-    call_flow_apps = client.call_flow_apps() or {"value": []}
+def print_call_flow_apps(call_flow_apps: dict) -> None:
     print("\nCall Flow Apps Files:")
     for item in call_flow_apps.get("value", []):
         if not item.get("Files") == []:
@@ -114,8 +126,6 @@ def print_call_flow_apps(client: api.APIClient) -> None:
             for file in item.get("Files", []):
                 print(f"  - File: {file}")
 
-    call_flow_apps = client.call_flow_apps() or {"value": []}
-
 
 def report_from_output(output_dir: str = "output") -> None:
     # load files from output/ (if present)
@@ -145,36 +155,81 @@ def report_from_output(output_dir: str = "output") -> None:
     print_report(usages)
 
 
-def report_from_api(client: api.APIClient) -> None:
-    prompts = client.custom_prompts() or {"value": []}
-    receptionists = client.receptionists() or {"value": []}
-    queues = client.queues() or {"value": []}
-    groups = client.groups() or {"value": []}
-    playlists = client.playlists() or {"value": []}
-    conference_settings = client.conference_settings() or {}
-    music_on_hold_settings = client.music_on_hold_settings() or {}
-    call_parking_settings = client.call_parking_settings() or {}
-    call_flow_apps = client.call_flow_apps() or {"value": []}
+def write_file(path: str, data: bytes) -> None:
+    """Write `data` to `path` through a raw file descriptor; the payload is already one buffer."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def dump_payload(path: str, payload: api.Payload, pretty: bool = False) -> None:
+    """Write a payload to `path` verbatim, or re-indented from its parsed form when `pretty` is set."""
+    write_file(path, orjson.dumps(payload.data, option=orjson.OPT_INDENT_2) if pretty else payload.raw)
 
+
+def load_fresh_payload(path: str, ttl: float) -> Optional[api.Payload]:
+    """Return the contents of `path` if it was written less than `ttl` seconds ago, otherwise None."""
+    try:
+        if time.time() - os.stat(path).st_mtime >= ttl:
+            return None
+        with open(path, "rb") as f:
+            return api.Payload(f.read())
+    except FileNotFoundError:
+        return None
+
+
+async def report_from_api(client: api.APIClient, pretty: bool = False, ttl: float = 0) -> None:
     os.makedirs("output", exist_ok=True)
-    with open("output/custom_prompts.json", "wb") as f:
-        f.write(orjson.dumps(prompts, option=orjson.OPT_INDENT_2))
-    with open("output/playlists.json", "wb") as f:
-        f.write(orjson.dumps(playlists, option=orjson.OPT_INDENT_2))
-    with open("output/receptionists.json", "wb") as f:
-        f.write(orjson.dumps(receptionists, option=orjson.OPT_INDENT_2))
-    with open("output/queues.json", "wb") as f:
-        f.write(orjson.dumps(queues, option=orjson.OPT_INDENT_2))
-    with open("output/groups.json", "wb") as f:
-        f.write(orjson.dumps(groups, option=orjson.OPT_INDENT_2))
-    with open("output/conference_settings.json", "wb") as f:
-        f.write(orjson.dumps(conference_settings, option=orjson.OPT_INDENT_2))
-    with open("output/music_on_hold_settings.json", "wb") as f:
-        f.write(orjson.dumps(music_on_hold_settings, option=orjson.OPT_INDENT_2))
-    with open("output/call_parking_settings.json", "wb") as f:
-        f.write(orjson.dumps(call_parking_settings, option=orjson.OPT_INDENT_2))
-    with open("output/call_flow_apps.json", "wb") as f:
-        f.write(orjson.dumps(call_flow_apps, option=orjson.OPT_INDENT_2))
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+
+        async def fetch(name: str, request) -> api.Payload:
+            path = os.path.join("output", f"{name}.json")
+            # Reuse an export from a recent run instead of asking the PBX again
+            payload = load_fresh_payload(path, ttl) if ttl > 0 else None
+            if payload is not None:
+                return payload
+            payload = await request()
+            # Write each file as soon as it arrives so disk I/O overlaps the requests still in flight
+            await loop.run_in_executor(pool, dump_payload, path, payload, pretty)
+            return payload
+
+        # All endpoints are independent, so fetch them concurrently
+        (
+            prompts,
+            receptionists,
+            queues,
+            groups,
+            playlists,
+            conference_settings,
+            music_on_hold_settings,
+            call_parking_settings,
+            call_flow_apps,
+        ) = await asyncio.gather(
+            fetch("custom_prompts", client.custom_prompts),
+            fetch("receptionists", client.receptionists),
+            fetch("queues", client.queues),
+            fetch("groups", client.groups),
+            fetch("playlists", client.playlists),
+            fetch("conference_settings", client.conference_settings),
+            fetch("music_on_hold_settings", client.music_on_hold_settings),
+            fetch("call_parking_settings", client.call_parking_settings),
+            fetch("call_flow_apps", client.call_flow_apps),
+        )
+
+    prompts = prompts.data or {"value": []}
+    receptionists = receptionists.data or {"value": []}
+    queues = queues.data or {"value": []}
+    groups = groups.data or {"value": []}
+    music_on_hold_settings = music_on_hold_settings.data or {}
+    conference_settings = conference_settings.data or {}
+    call_parking_settings = call_parking_settings.data or {}
+    call_flow_apps = call_flow_apps.data or {"value": []}
 
     prompt_filenames = {p.get("DisplayName") for p in prompts.get("value", []) if p.get("DisplayName")}
 
@@ -189,31 +244,36 @@ def report_from_api(client: api.APIClient) -> None:
     )
 
     print_report(usages)
-    print_call_flow_apps(client)
+    print_call_flow_apps(call_flow_apps)
 
 
-def main():
+async def main(pretty: bool = False, refresh: bool = False):
     output_dir = "output"
-    if os.path.isdir(output_dir) and os.path.exists(os.path.join(output_dir, "custom_prompts.json")):
+    fqdn = os.environ.get("FQDN")
+    # os.path.isfile is a single stat and also covers a missing output directory
+    if not fqdn and os.path.isfile(os.path.join(output_dir, "custom_prompts.json")):
+        # No PBX configured, so report on the last export regardless of its age
         report_from_output(output_dir)
         return
 
-    fqdn = os.environ.get("FQDN")
+    ttl = 0.0 if refresh else float(os.environ.get("CACHE_TTL") or DEFAULT_CACHE_TTL)
     token = os.environ.get("BEARER_TOKEN")
     if not token:
         token = ""
 
-    client = api.APIClient(token=token, fqdn=fqdn)
-    report_from_api(client)
+    async with api.APIClient(token=token, fqdn=fqdn, cache_dir=os.path.join(output_dir, ".cache")) as client:
+        await report_from_api(client, pretty=pretty, ttl=ttl)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="3CX Prompt Usage Reporter")
     parser.add_argument("--clear", action="store_true", help="Clear the output directory before running")
+    parser.add_argument("--refresh", action="store_true", help="Fetch everything from the API even if the output directory is recent")
+    parser.add_argument("--pretty", action="store_true", help="Indent the JSON files written to the output directory")
     args = parser.parse_args()
 
     if args.clear:
         if os.path.isdir("output"):
             shutil.rmtree("output")
 
-    main()
+    asyncio.run(main(pretty=args.pretty, refresh=args.refresh))